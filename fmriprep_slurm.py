@@ -22,11 +22,22 @@ p.add_argument('--ncpu',type=int,default=8,help='number of cpus per subject')
 p.add_argument('--mem',default=10000,type=int,metavar='MB',help='memory per subject in MB',dest='mem')
 p.add_argument('--partition',default="general",help='SLURM partition')
 p.add_argument('--limit',type=int,help='max number of subjects to run concurrently')
+p.add_argument('--io_tokens',type=int,help='max subjects concurrently in their I/O-heavy early stages (shared lock-file token pool, scaled down when the filesystem is slow). Time spent waiting for a token counts against --hrs-per-sub walltime')
+p.add_argument('--io_min_tokens',type=int,default=1,help='min tokens admitted regardless of measured I/O latency')
+p.add_argument('--io_hold',type=int,default=120,metavar='MIN',help='minutes a subject holds its I/O token after starting')
+p.add_argument('--io_target_ms',type=float,default=50.0,help='write/fsync probe latency (ms) at which all --io_tokens are admitted')
+p.add_argument('--io_lock_dir',help='token directory, must be on the shared filesystem (default: out_dir/.io_tokens)')
+p.add_argument('--profile',action='store_true',help="enable nipype resource monitoring in fmriprep (--resource-monitor) and keep node results in out_dir/work (unless -w is passed via --fmriprep) for profile_report.py")
 p.add_argument('--hrs-per-sub',type=int,default=24,help='number of hours to devote to each subject for walltime purposes (be liberal)',dest='hrs')
 p.add_argument('--container',default='singularity',help='container executable')
 p.add_argument('--container_img',default='%s/local/simg/fmriprep-latest.simg' % os.environ["HOME"],help='fmriprep container image',dest='img')
 p.add_argument('--cmd_pre',default='',help='setup code to run (inline os.system) prior to main container call. useful to setup enviorment')
 args = p.parse_args()
+if args.io_tokens is not None:
+    if args.io_tokens < 1:
+        p.error('--io_tokens must be at least 1')
+    if args.io_min_tokens < 1 or args.io_min_tokens > args.io_tokens:
+        p.error('--io_min_tokens must be between 1 and --io_tokens')
 args.out_dir = args.out_dir.replace('~',os.environ['HOME'])
 args.bids_dir = args.bids_dir.replace('~',os.environ['HOME'])
 #print(args)
@@ -57,12 +68,21 @@ if n >= 1:
 
     # setup fmriprep parameters
     fmriprep = [args.bids_dir, args.out_dir,'participant','--nthreads',str(args.ncpu),'--mem-mb',str(args.mem)] + args.fmriprep
+    if args.profile:
+        fmriprep = fmriprep + ['--resource-monitor']
+        if not any(a == '-w' or a.startswith('--work-dir') for a in fmriprep):
+            fmriprep = fmriprep + ['-w',os.path.join(args.out_dir,'work')]
 
     # generate SLURM sbatch file
     slurmDir = os.path.join(args.out_dir,"slurm")
     if not os.path.exists(slurmDir):
         os.makedirs(slurmDir)
 
+    # shared I/O token directory
+    io_lock_dir = args.io_lock_dir if args.io_lock_dir is not None else os.path.join(args.out_dir,".io_tokens")
+    if args.io_tokens is not None and not os.path.exists(io_lock_dir):
+        os.makedirs(io_lock_dir)
+
     print textwrap.dedent("""\
     #!/usr/bin/env python2
     #SBATCH --partition=%s
@@ -74,11 +94,19 @@ if n >= 1:
     #SBATCH --output=%s/fmriprep_%%A_%%a.out
     #SBATCH --error=%s/fmriprep_%%A_%%a.err
 
+    import sys
     from os import system,environ
 
     # setup subject array""" % (args.partition,args.ncpu,args.mem,time,n-1,limit,slurmDir,slurmDir))
     print "sub = %s" % sub
     print 'tid = int(environ["SLURM_ARRAY_TASK_ID"])'
-    print 'system("%s%s run %s %s --participant_label %%s" %% sub[tid])' % (args.cmd_pre,args.container,args.img,' '.join(fmriprep))
+    cmd = '"%s%s run %s %s --participant_label %%s" %% sub[tid]' % (args.cmd_pre,args.container,args.img,' '.join(fmriprep))
+    if args.io_tokens is not None:
+        # gate container start on the shared I/O token pool (see io_admission.py)
+        print 'sys.path.insert(0, "%s")' % os.path.dirname(os.path.abspath(__file__))
+        print 'from io_admission import run_gated'
+        print 'run_gated(%s, "%s", %d, min_tokens=%d, hold=%d, target_ms=%s, label="sub-%%s" %% sub[tid])' % (cmd,io_lock_dir,args.io_tokens,args.io_min_tokens,args.io_hold*60,args.io_target_ms)
+    else:
+        print 'system(%s)' % cmd
 else:
     sys.exit('No sub- dirs found in %s' % args.bids_dir)
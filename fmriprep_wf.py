@@ -7,6 +7,7 @@ import pandas as pd
 import numpy as np
 from multiprocessing import Pool
 import time
+from functools import partial
 import nibabel as nib
 
 # find matching functional data for an individual subject
@@ -234,12 +235,33 @@ def _get_template(space, resolution=None, suffix='T1w'):
 def _get_dims(nifti):
     return nib.load(nifti).header.get('dim')[1:4]
 
+# log nipype node runtime/memory/cpu (callback + resource monitor) to a json-lines file, see profile_report.py
+def _start_callback_log(log_file):
+    import logging
+    from nipype import config
+    config.enable_resource_monitor()
+    os.makedirs(os.path.dirname(log_file), exist_ok=True)
+    handler = logging.FileHandler(log_file, mode='w') # a rerun re-logs cached nodes, keep only the latest run
+    logger = logging.getLogger('callback')
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    return handler
+
+def _stop_callback_log(handler):
+    import logging
+    logging.getLogger('callback').removeHandler(handler)
+    handler.close()
+
 # run tedana_workflow
-def run_tedana(prefix, echo_images, echo_times, out_dir, fittype='curvefit', tedpca='kundu', gscontrol=None):
+def run_tedana(prefix, echo_images, echo_times, out_dir, fittype='curvefit', tedpca='kundu', gscontrol=None, log_dir=None):
     from tedana.workflows import tedana_workflow
+    import resource
+    from datetime import datetime
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
 
+    start = datetime.utcnow() # nipype stamps runtime.startTime/endTime in UTC
+    usage = resource.getrusage(resource.RUSAGE_SELF) # ru_maxrss already holds the RSS inherited from the parent
     tedana_workflow(
         echo_images,
         echo_times,
@@ -250,12 +272,39 @@ def run_tedana(prefix, echo_images, echo_times, out_dir, fittype='curvefit', ted
         verbose=True,
         gscontrol=gscontrol)
 
-
-def run_cifti_wf(inDir, workingDir, row, density='91k'):
+    # tedana isn't a nipype workflow, log it as a single node in the same format as nipype's log_nodes_cb
+    if log_dir is not None:
+        finish = datetime.utcnow()
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        duration = (finish - start).total_seconds()
+        cpu = (end_usage.ru_utime + end_usage.ru_stime) - (usage.ru_utime + usage.ru_stime)
+        status = {
+            'name': f'tedana_{fittype}',
+            'id': f'{prefix}_tedana',
+            'start': start.isoformat(),
+            'finish': finish.isoformat(),
+            'duration': duration,
+            'runtime_threads': 100 * cpu / duration if duration > 0 else 'N/A',
+            'runtime_memory_gb': end_usage.ru_maxrss / 1024**2, # upper bound, includes the RSS the forked worker inherited
+            'baseline_memory_gb': usage.ru_maxrss / 1024**2,
+            'estimated_memory_gb': 'N/A',
+            'num_threads': 'N/A',
+        }
+        os.makedirs(log_dir, exist_ok=True)
+        with open(os.path.join(log_dir, f'{prefix}_tedana_callback.log'), 'w') as f:
+            f.write(json.dumps(status) + '\n')
+
+
+def run_cifti_wf(inDir, workingDir, row, density='91k', profile=False):
     from fmriprep.workflows.bold.resampling import init_bold_surf_wf, init_bold_grayords_wf
     import nipype.interfaces.io as nio
     from nipype.interfaces import utility as niu
     from nipype.pipeline import engine as pe
+    from nipype.utils.profiler import log_nodes_cb
+
+    # per-subject node profiling log
+    if profile:
+        handler = _start_callback_log(os.path.join(workingDir, 'profile', f'sub-{row["sub"]}', f'{row["prefix"]}_cifti_callback.log'))
 
     wf = pe.Workflow(name=f'{row["prefix"]}_cifti_wf', base_dir=os.path.join(workingDir, "cifti_wf"))
     
@@ -299,10 +348,16 @@ def run_cifti_wf(inDir, workingDir, row, density='91k'):
         outfolder = f'{outfolder}.ses-{row["ses"]}'
     wf.connect(cifti_wf, "outputnode.cifti_bold", ds, f'{outfolder}.func')
 
-    wf.run()
+    if profile:
+        try:
+            wf.run(plugin='Linear', plugin_args={'status_callback': log_nodes_cb})
+        finally:
+            _stop_callback_log(handler)
+    else:
+        wf.run()
 
 
-def main_tedana(inDir, workingDir, sub, cores, space='MNI152NLin6Asym', tedana=True, fittype='curvefit', tedpca='kundu', gscontrol=None, cifti=True):
+def main_tedana(inDir, workingDir, sub, cores, space='MNI152NLin6Asym', tedana=True, fittype='curvefit', tedpca='kundu', gscontrol=None, cifti=True, profile=False):
     # run get ME data and run tedana in parallel
     df = find_multiecho_data(inDir, sub)
 
@@ -312,8 +367,9 @@ def main_tedana(inDir, workingDir, sub, cores, space='MNI152NLin6Asym', tedana=T
         # run tedana
         if tedana:
             data = df.loc[:, ['prefix', 'echo_images', 'echo_times', 'out_dir']].values.tolist()
-            data = [d + [fittype, tedpca, gscontrol] for d in data]
-            pool = Pool(cores)
+            log_dir = os.path.join(workingDir, 'profile', f'sub-{sub}') if profile else None
+            data = [d + [fittype, tedpca, gscontrol, log_dir] for d in data]
+            pool = Pool(cores, maxtasksperchild=1) # fresh worker per run, so ru_maxrss doesn't carry over earlier runs
             pool.starmap(run_tedana, data)
             pool.close()
         # find tedana outputs and transform to cifti
@@ -341,7 +397,7 @@ def main_tedana(inDir, workingDir, sub, cores, space='MNI152NLin6Asym', tedana=T
             # run cifti pipeline
             if cifti:
                     pool = Pool(cores)
-                    pool.starmap(run_cifti_wf, args)
+                    pool.starmap(partial(run_cifti_wf, profile=profile), args)
                     pool.close()
         else:
             raise Exception("No tedana outputs found")
@@ -350,7 +406,7 @@ def main_tedana(inDir, workingDir, sub, cores, space='MNI152NLin6Asym', tedana=T
     return df
 
 
-def main_cifti(inDir, workingDir, sub, cores, suffix='*-preproc_bold.nii.gz', outputSpace='MNI152NLin6Asym', dummyRun=False):
+def main_cifti(inDir, workingDir, sub, cores, suffix='*-preproc_bold.nii.gz', outputSpace='MNI152NLin6Asym', dummyRun=False, profile=False):
     # run get ME data and run tedana in parallel
     df = find_func_data(inDir, sub, suffix)
 
@@ -405,10 +461,10 @@ def main_cifti(inDir, workingDir, sub, cores, suffix='*-preproc_bold.nii.gz', ou
         if not dummyRun:
             if cores == 1:
                 for a in args:
-                    run_cifti_wf(*a)
+                    run_cifti_wf(*a, profile=profile)
             else:
                 pool = Pool(cores)
-                pool.starmap(run_cifti_wf, args)
+                pool.starmap(partial(run_cifti_wf, profile=profile), args)
                 pool.close()
     else:
         raise Exception('Could not find any functional data')
@@ -422,6 +478,7 @@ if __name__ == '__main__':
     parser.add_argument('--cores', default=2, type=int)
     parser.add_argument('--space', default='MNI152NLin6Asym', type=str)
     parser.add_argument('--dummyRun', default=False, action='store_true', help='gather files but don\'t run')
+    parser.add_argument('--profile', default=False, action='store_true', help='log nipype node runtime/memory/cpu to <workingDir>/profile for profile_report.py')
     #parser.add_argument('--skipTedana', default=True, action='store_false', help='don\'t run tedana')
     #parser.add_argument('--skipCifti', default=True, action='store_false', help='don\'t transform tedana outputs to CIFTI')
     #parser.add_argument('--fittype', default='curvefit', type=str)
@@ -431,5 +488,5 @@ if __name__ == '__main__':
     if args.sub is not None:
         args.sub = args.sub.replace('sub-', '')
 
-    main_cifti(args.derivativeDir, args.workingDir, args.sub, cores=args.cores, space=space, dummyRun=args.dummyRun)
+    main_cifti(args.derivativeDir, args.workingDir, args.sub, cores=args.cores, space=space, dummyRun=args.dummyRun, profile=args.profile)
 
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+#
+# shared-filesystem admission control for array jobs (python2/3, stdlib only)
+#
+# Jobs take a token (lock file in a directory on the output filesystem) before
+# starting their I/O-heavy early stages and hand it back after a hold period.
+# The number of usable tokens scales with the latency of a small write/fsync
+# probe, so fewer subjects are admitted while the filesystem is slow.
+import os,sys,time,socket,random,subprocess,argparse
+
+# time a small write + fsync + read + unlink on the shared filesystem (ms)
+def probe_latency(lock_dir, nbytes=65536, repeats=3):
+    data = os.urandom(nbytes)
+    probe = os.path.join(lock_dir, 'probe-%s-%d-%d' % (socket.gethostname(), os.getpid(), random.randint(0, 10**9)))
+    times = []
+    for i in range(repeats):
+        t0 = time.time()
+        with open(probe, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(probe, 'rb') as f:
+            f.read()
+        os.remove(probe)
+        times.append((time.time() - t0) * 1000.0)
+    times.sort()
+    return times[len(times) // 2]
+
+# latest probe shared through lock_dir/latency, so waiting jobs don't all probe the filesystem
+def shared_latency(lock_dir, max_age=30):
+    cache = os.path.join(lock_dir, 'latency')
+    try:
+        with open(cache) as f:
+            stamp, latency = f.read().split()
+        if time.time() - float(stamp) < max_age:
+            return float(latency)
+    except (IOError, OSError, ValueError):
+        pass # missing, or being replaced by another job
+    latency = probe_latency(lock_dir)
+    tmp = '%s-%s-%d-%d' % (cache, socket.gethostname(), os.getpid(), random.randint(0, 10**9))
+    with open(tmp, 'w') as f:
+        f.write('%f %f\n' % (time.time(), latency))
+    os.rename(tmp, cache)
+    return latency
+
+# scale the token pool by target / measured latency, clamped to [min_tokens, max_tokens]
+def allowed_tokens(latency_ms, max_tokens, min_tokens=1, target_ms=50.0):
+    if latency_ms <= 0:
+        return max_tokens
+    n = int(max_tokens * target_ms / latency_ms)
+    return max(min_tokens, min(max_tokens, n))
+
+# token owner, written first in the token file
+def _owner():
+    return '%s %d' % (socket.gethostname(), os.getpid())
+
+def _tokens(lock_dir):
+    return [f for f in os.listdir(lock_dir) if f.startswith('token-')]
+
+# remove token files older than stale seconds (holder died without releasing)
+def clear_stale(lock_dir, stale):
+    for f in _tokens(lock_dir):
+        token = os.path.join(lock_dir, f)
+        try:
+            if time.time() - os.path.getmtime(token) <= stale:
+                continue
+            with open(token) as t:
+                contents = t.read()
+            moved = os.path.join(lock_dir, 'stale-%s-%d' % (_owner().replace(' ', '-'), random.randint(0, 10**9)))
+            os.rename(token, moved)
+            with open(moved) as t:
+                if t.read() == contents:
+                    os.remove(moved) # still the stale token
+                    continue
+        except (IOError, OSError):
+            continue # released or cleared by another job in the meantime
+        # another job cleared the stale token and took the slot before the rename: put its token
+        # back. If the slot was taken yet again (or hard links aren't supported) its token is lost
+        # and the pool over-admits by one until that holder is done; release() checks the owner,
+        # so the holder won't delete someone else's token. The window is the few ms between the
+        # read and the rename above.
+        try:
+            os.link(moved, token)
+        except OSError:
+            pass
+        os.remove(moved)
+
+# take a free token slot if fewer than n tokens are held, return its path or None
+def try_acquire(lock_dir, n, max_tokens, label=''):
+    if len(_tokens(lock_dir)) >= n:
+        return None
+    for i in range(max_tokens):
+        token = os.path.join(lock_dir, 'token-%d' % i)
+        try:
+            fd = os.open(token, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            continue
+        os.write(fd, ('%s %s %f\n' % (_owner(), label, time.time())).encode())
+        os.close(fd)
+        return token
+    return None
+
+# remove token if this process still owns it (it may have been cleared as stale and re-taken)
+def release(token):
+    try:
+        with open(token) as t:
+            if t.read().startswith(_owner() + ' '):
+                os.remove(token)
+    except (IOError, OSError):
+        pass
+
+# block until a token is free, log the wait to stdout and lock_dir/waits.tsv
+def acquire(lock_dir, max_tokens, min_tokens=1, target_ms=50.0, poll=30, stale=6*3600, label=''):
+    if not os.path.exists(lock_dir):
+        try:
+            os.makedirs(lock_dir)
+        except OSError:
+            pass # created by a concurrent job
+    t0 = time.time()
+    probes = 0
+    while True:
+        latency = shared_latency(lock_dir, poll)
+        n = allowed_tokens(latency, max_tokens, min_tokens, target_ms)
+        probes += 1
+        clear_stale(lock_dir, stale)
+        token = try_acquire(lock_dir, n, max_tokens, label)
+        if token is not None:
+            break
+        time.sleep(poll * random.uniform(0.5, 1.5)) # jitter so waiting jobs don't poll in lockstep
+    wait = time.time() - t0
+    print('io_admission: %s acquired %s after %.1fs (%d checks, %.1fms latency, %d/%d tokens)' % (label, os.path.basename(token), wait, probes, latency, n, max_tokens))
+    sys.stdout.flush()
+    with open(os.path.join(lock_dir, 'waits.tsv'), 'a') as f:
+        f.write('%s\t%s\t%s\t%.1f\t%d\t%.1f\t%d\t%d\n' % (time.strftime('%Y-%m-%dT%H:%M:%S'), label, socket.gethostname(), wait, probes, latency, n, max_tokens))
+    return token
+
+# run cmd (shell) once a token is held, release it after hold seconds or on exit
+def run_gated(cmd, lock_dir, max_tokens, min_tokens=1, hold=3600, target_ms=50.0, poll=30, label=''):
+    token = acquire(lock_dir, max_tokens, min_tokens, target_ms, poll, stale=hold + 2*poll + 60, label=label)
+    try:
+        proc = subprocess.Popen(cmd, shell=True)
+        t0 = time.time()
+        while proc.poll() is None and time.time() - t0 < hold:
+            time.sleep(min(poll, 5))
+    finally:
+        release(token)
+    print('io_admission: %s released %s after %.1fs' % (label, os.path.basename(token), time.time() - t0))
+    sys.stdout.flush()
+    return proc.wait()
+
+if __name__ == '__main__':
+    # standalone probe, e.g. to choose --io_target_ms for a filesystem
+    p = argparse.ArgumentParser(description='probe write/fsync latency of a (shared) directory and report admitted tokens')
+    p.add_argument('lock_dir',help='directory on the filesystem to probe')
+    p.add_argument('--max_tokens',type=int,default=8,help='token pool size')
+    p.add_argument('--min_tokens',type=int,default=1,help='minimum tokens regardless of latency')
+    p.add_argument('--target_ms',type=float,default=50.0,help='probe latency at which the full pool is admitted')
+    args = p.parse_args()
+    latency = probe_latency(args.lock_dir)
+    print('%.1fms latency, %d/%d tokens' % (latency, allowed_tokens(latency, args.max_tokens, args.min_tokens, args.target_ms), args.max_tokens))
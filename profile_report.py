@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# coding: utf-8
+#
+# merge nipype node profiling across a cohort into per-node runtime / memory / cpu
+# distributions and per-subject critical paths
+#
+# inputs:
+#   callback logs (json lines, nipype's log_nodes_cb format) written by run_cifti_wf / run_tedana
+#     to <workingDir>/profile/sub-<sub>/*_callback.log
+#   fmriprep working directories (fmriprep_pbs.py / fmriprep_slurm.py --profile), read from
+#     the node result_*.pklz files (needs nipype + fmriprep importable, e.g. inside the container)
+
+import argparse
+import os
+import re
+import json
+from glob import glob
+import pandas as pd
+import numpy as np
+
+# subject label from a log / working directory path
+def _sub_from_path(path):
+    m = re.search(r'single_subject_(.+?)_wf', path)
+    if m:
+        return m.group(1)
+    m = re.findall(r'sub-([^/_.]+)', path)
+    if m:
+        return m[-1]
+    return None
+
+
+def _to_frame(rows, source):
+    df = pd.DataFrame(rows, columns=['sub', 'name', 'id', 'start', 'finish', 'duration', 'runtime_threads', 'runtime_memory_gb', 'estimated_memory_gb', 'num_threads'])
+    df['source'] = source
+    df['start'] = pd.to_datetime(df['start'], errors='coerce')
+    df['finish'] = pd.to_datetime(df['finish'], errors='coerce')
+    for c in ['duration', 'runtime_threads', 'runtime_memory_gb', 'estimated_memory_gb', 'num_threads']:
+        df[c] = pd.to_numeric(df[c], errors='coerce') # 'N/A' when the resource monitor was off
+    df['cpu'] = df['runtime_threads'] / 100 # cpu_percent -> cores
+    return df.dropna(subset=['sub', 'start', 'finish'])
+
+
+# read one callback log (one json dict per finished node)
+def read_callback_log(file, sub=None):
+    if sub is None:
+        sub = _sub_from_path(file)
+    rows = []
+    with open(file) as f:
+        for line in f:
+            try:
+                status = json.loads(line)
+            except ValueError:
+                continue
+            if status.get('error'):
+                continue
+            status['sub'] = sub
+            rows.append(status)
+    return _to_frame(rows, os.path.basename(file))
+
+
+# read node runtimes from a nipype (fmriprep) working directory
+def read_nipype_results(workDir):
+    from nipype.utils.filemanip import loadpkl
+    rows = []
+    skipped = 0
+    # only fmriprep's subject workflows, run_cifti_wf results (<workingDir>/cifti_wf) come from the callback logs
+    for f in glob(os.path.join(workDir, '**', 'single_subject_*_wf', '**', 'result_*.pklz'), recursive=True):
+        try:
+            result = loadpkl(f)
+        except Exception:
+            skipped += 1
+            continue
+        runtime = getattr(result, 'runtime', None)
+        # MapNode parents hold a list, their subnodes (_<name><i>) have their own result files
+        if runtime is None or isinstance(runtime, list):
+            continue
+        name = os.path.basename(f)[len('result_'):-len('.pklz')]
+        name = re.sub(r'^_(.+?)\d+$', r'\1', name)
+        rows.append({
+            'sub': _sub_from_path(f),
+            'name': name,
+            'id': os.path.relpath(os.path.dirname(f), workDir),
+            'start': getattr(runtime, 'startTime', None),
+            'finish': getattr(runtime, 'endTime', None),
+            'duration': getattr(runtime, 'duration', None),
+            'runtime_threads': getattr(runtime, 'cpu_percent', None),
+            'runtime_memory_gb': getattr(runtime, 'mem_peak_gb', None),
+            'estimated_memory_gb': None,
+            'num_threads': None,
+        })
+    if skipped:
+        print(f'WARNING: could not load {skipped} result files in {workDir}')
+    return _to_frame(rows, 'fmriprep')
+
+
+# per-subject critical path from node start/finish times
+def critical_path(df):
+    # the logs have no graph edges, so walk back from the last node to finish, each step taking
+    # the latest-finishing node that had finished before the current one started
+    df = df.sort_values('finish').reset_index(drop=True)
+    finish = df['finish'].values
+    path = [len(df) - 1]
+    while True:
+        i = np.searchsorted(finish, df.loc[path[-1], 'start'].to_datetime64(), side='right') - 1
+        # always step back, even for zero-length nodes or clocks disagreeing between sources
+        i = min(i, path[-1] - 1)
+        if i < 0:
+            break
+        path.append(i)
+    return df.loc[path[::-1]]
+
+
+def summarize(df, paths):
+    g = df.groupby('name')
+    summary = pd.DataFrame({
+        'n': g.size(),
+        'subjects': g['sub'].nunique(),
+        'runtime_total_h': g['duration'].sum() / 3600,
+        'runtime_median_s': g['duration'].median(),
+        'runtime_p90_s': g['duration'].quantile(0.9),
+        'runtime_max_s': g['duration'].max(),
+        'mem_median_gb': g['runtime_memory_gb'].median(),
+        'mem_max_gb': g['runtime_memory_gb'].max(),
+        'mem_estimated_gb': g['estimated_memory_gb'].max(),
+        'cpu_median': g['cpu'].median(),
+        'num_threads': g['num_threads'].max(),
+    })
+    c = paths.groupby('name')
+    summary['critical_subjects'] = c['sub'].nunique()
+    summary['critical_total_h'] = c['duration'].sum() / 3600
+    summary['critical_subjects'] = summary['critical_subjects'].fillna(0).astype(int)
+    summary['critical_total_h'] = summary['critical_total_h'].fillna(0)
+    summary['critical_share'] = summary['critical_total_h'] / (paths['duration'].sum() / 3600)
+    # resource hints: peak memory above the node's mem_gb, or most of the requested threads idle
+    hint = pd.Series('', index=summary.index)
+    hint[summary['mem_max_gb'] > summary['mem_estimated_gb']] += 'more mem_gb; '
+    hint[(summary['num_threads'] > 1) & (summary['cpu_median'] < summary['num_threads'] / 2)] += 'fewer threads; '
+    summary['hint'] = hint.str.rstrip('; ')
+    return summary.sort_values(['critical_total_h', 'runtime_total_h'], ascending=False)
+
+
+def main(profileDir=[], workDir=[], outDir=None, top=20):
+    df = []
+    for d in profileDir:
+        for log in glob(os.path.join(d, '**', '*callback*.log'), recursive=True):
+            df.append(read_callback_log(log))
+    for d in workDir:
+        df.append(read_nipype_results(d))
+    df = [d for d in df if not d.empty]
+    if not df:
+        raise Exception('No profiling data found')
+    df = pd.concat(df, ignore_index=True)
+    # cached nodes are re-logged with their original runtimes on every rerun
+    df = df.drop_duplicates(subset=['sub', 'id', 'start', 'finish'])
+
+    # critical path per subject
+    paths = []
+    subs = []
+    for sub, d in df.groupby('sub'):
+        path = critical_path(d)
+        paths.append(path)
+        subs.append((sub, len(d), (d['finish'].max() - d['start'].min()).total_seconds() / 3600,
+                     path['duration'].sum() / 3600, path.loc[path['duration'].idxmax(), 'name']))
+    paths = pd.concat(paths, ignore_index=True)
+    subs = pd.DataFrame(subs, columns=['sub', 'nodes', 'wall_h', 'critical_h', 'critical_max_node'])
+
+    summary = summarize(df, paths)
+
+    print(f'{df.shape[0]} node runs, {df["name"].nunique()} nodes, {subs.shape[0]} subjects')
+    print(f'median wall time {subs["wall_h"].median():.2f}h, critical path {subs["critical_h"].median():.2f}h\n')
+    with pd.option_context('display.width', 200, 'display.max_columns', None, 'display.float_format', '{:.2f}'.format):
+        print(summary.head(top).loc[:, ['n', 'subjects', 'runtime_median_s', 'runtime_p90_s', 'mem_max_gb', 'cpu_median', 'critical_subjects', 'critical_share', 'hint']])
+
+    if outDir is not None:
+        os.makedirs(outDir, exist_ok=True)
+        df.to_csv(os.path.join(outDir, 'profile_nodes.csv'), index=False)
+        summary.to_csv(os.path.join(outDir, 'profile_node_summary.csv'))
+        paths.to_csv(os.path.join(outDir, 'profile_critical_path.csv'), index=False)
+        subs.to_csv(os.path.join(outDir, 'profile_subjects.csv'), index=False)
+        print(f'\nSaved to "{outDir}"')
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='merge nipype node profiling across subjects into a hot-spot report')
+    parser.add_argument('--profileDir', default=[], nargs='+', type=str, help='directories with *callback*.log files (e.g. <workingDir>/profile from fmriprep_wf.py)')
+    parser.add_argument('--workDir', default=[], nargs='+', type=str, help='fmriprep working directories (run with --profile)')
+    parser.add_argument('--outDir', default=None, type=str, help='directory to save csv tables')
+    parser.add_argument('--top', default=20, type=int, help='number of nodes to print')
+    args = parser.parse_args()
+
+    main(args.profileDir, args.workDir, args.outDir, args.top)